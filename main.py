@@ -1,17 +1,27 @@
+import hashlib
+import logging
 import os
 import secrets
 from datetime import datetime, timedelta, date
 from typing import Optional, Literal
 
+import bcrypt
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException, Depends, Cookie, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, Field, model_validator
+from pymongo import WriteConcern
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
 from database import db, create_document, get_documents
-from schemas import User, Subscription, Client, Invoice
+from schemas import Email, Tin, Phone, IssueDate, Subscription
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,6 +36,17 @@ class PlanLimits(BaseModel):
     name: Literal["basic", "professional", "enterprise"]
     client_limit: Optional[int]
     invoice_monthly_limit: Optional[int]
+    # 80% warning thresholds, derived once when PLANS is built
+    client_warn: Optional[int] = None
+    invoice_warn: Optional[int] = None
+
+    @model_validator(mode="after")
+    def derive_warnings(self):
+        if self.client_limit:
+            self.client_warn = self.client_limit * 8 // 10
+        if self.name == "basic" and self.invoice_monthly_limit is not None:
+            self.invoice_warn = self.invoice_monthly_limit * 8 // 10
+        return self
 
 PLANS = {
     "basic": PlanLimits(name="basic", client_limit=15, invoice_monthly_limit=20),
@@ -36,48 +57,119 @@ PLANS = {
 # ---------- Auth helpers ----------
 SESSION_COOKIE = "session_token"
 
+# token -> (user doc, session expiry); keeps auth off Mongo for repeat requests
+_sess_cache = TTLCache(maxsize=10_000, ttl=60)
+
 class AuthRequest(BaseModel):
     name: Optional[str] = None
-    email: EmailStr
+    email: Email
     password: str
     plan: Literal["basic", "professional", "enterprise"] = "basic"
     company_name: Optional[str] = None
-    company_tin: Optional[str] = None
-    phone: Optional[str] = None
+    company_tin: Optional[Tin] = None
+    phone: Optional[Phone] = None
 
 class LoginRequest(BaseModel):
-    email: EmailStr
+    email: Email
     password: str
 
 class MeResponse(BaseModel):
     name: str
-    email: EmailStr
+    email: Email
     plan: str
     role: str
 
-# naive password hash placeholder (do NOT use in production)
+# bcrypt password hashing (salt is embedded in the returned hash)
 def hash_password(p: str) -> str:
-    return secrets.token_hex(8) + str(abs(hash(p)))
+    return bcrypt.hashpw(p.encode(), bcrypt.gensalt(rounds=12)).decode()
+
+def verify_password(p: str, password_hash: str) -> bool:
+    try:
+        return bcrypt.checkpw(p.encode(), password_hash.encode())
+    except ValueError:
+        # legacy/malformed hash
+        return False
+
+# Serve pre-encoded JSON with an ETag, answering 304 when the client already has it
+def cached_json(request: Request, body: bytes, cache_control: str, etag: Optional[str] = None,
+                vary: Optional[str] = None) -> Response:
+    etag = etag or '"%s"' % hashlib.md5(body).hexdigest()
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if vary:
+        headers["Vary"] = vary
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 # Obtain user by session
 async def get_current_user(request: Request) -> dict:
     token = request.cookies.get(SESSION_COOKIE)
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    sess = db["session"].find_one({"token": token})
-    if not sess:
+    cached = _sess_cache.get(token)
+    if cached is not None:
+        user, expires_at = cached
+        if expires_at is None or expires_at > datetime.utcnow():
+            return user
+        _sess_cache.pop(token, None)
+    # session + user in a single round-trip
+    docs = await db["session"].aggregate([
+        {"$match": {"token": token}},
+        {"$limit": 1},
+        {"$lookup": {"from": "user", "localField": "user_id", "foreignField": "_id", "as": "user"}},
+    ]).to_list(1)
+    if not docs:
         raise HTTPException(status_code=401, detail="Invalid session")
-    user = db["user"].find_one({"_id": sess["user_id"]})
-    if not user:
+    if not docs[0]["user"]:
         raise HTTPException(status_code=401, detail="User not found")
+    user = docs[0]["user"][0]
+    expires_at = docs[0].get("expires_at")
+    if expires_at is None or expires_at > datetime.utcnow():
+        _sess_cache[token] = (user, expires_at)
     return user
 
+# Sessions are disposable, so acknowledge inserts without waiting for the journal flush
+_SESSION_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+async def create_session(user_id) -> str:
+    token = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    await db["session"].with_options(write_concern=_SESSION_WRITE_CONCERN).insert_one({
+        "user_id": user_id,
+        "token": token,
+        "created_at": now,
+        "expires_at": now + timedelta(days=30)
+    })
+    return token
+
+# (collection, keys, create_index options) ensured at startup
+INDEXES = [
+    ("session", "token", {"unique": True}),
+    # let Mongo reap expired sessions
+    ("session", "expires_at", {"expireAfterSeconds": 0}),
+    ("user", "email", {"unique": True}),
+    ("client", [("owner_id", 1)], {}),
+    ("invoice", [("owner_id", 1), ("created_at", 1)], {}),
+]
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    # index failures must not keep the app from booting (or block the other indexes);
+    # /test reports DB state
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except PyMongoError as e:
+            logger.error("Index creation failed on %s %s: %s", collection, keys, e)
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Subscription Backend Running"}
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -90,7 +182,7 @@ def test_database():
         if db is not None:
             response["database"] = "✅ Available"
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()
+            response["collections"] = await db.list_collection_names()
             response["database"] = "✅ Connected & Working"
     except Exception as e:
         response["database"] = f"⚠️ Error: {str(e)[:80]}"
@@ -98,74 +190,71 @@ def test_database():
 
 # ---------- Auth endpoints ----------
 @app.post("/auth/register")
-def register(payload: AuthRequest):
+async def register(payload: AuthRequest):
     # ensure unique email
-    if db["user"].find_one({"email": payload.email}):
+    if await db["user"].find_one({"email": payload.email}):
         raise HTTPException(400, detail="Email already registered")
 
-    subscription = Subscription(plan=payload.plan)
-    user = User(
-        name=payload.name or "User",
-        email=payload.email,
-        password_hash=hash_password(payload.password),
-        company_name=payload.company_name,
-        company_tin=payload.company_tin,
-        phone=payload.phone,
-        subscription=subscription,
-    )
-    user_id = db["user"].insert_one(user.model_dump()).inserted_id
+    # payload is already validated; build the User document directly
+    user_doc = {
+        "name": payload.name or "User",
+        "email": payload.email,
+        "password_hash": await run_in_threadpool(hash_password, payload.password),
+        "company_name": payload.company_name,
+        "company_tin": payload.company_tin,
+        "phone": payload.phone,
+        "subscription": Subscription(plan=payload.plan).model_dump(),
+        "role": "owner",
+        "is_active": True,
+        "clients_count": 0,
+    }
+    try:
+        user_id = (await db["user"].insert_one(user_doc)).inserted_id
+    except DuplicateKeyError:
+        # lost the race against a concurrent registration (unique email index)
+        raise HTTPException(400, detail="Email already registered")
 
-    token = secrets.token_urlsafe(32)
-    db["session"].insert_one({
-        "user_id": user_id,
-        "token": token,
-        "created_at": datetime.utcnow(),
-        "expires_at": datetime.utcnow() + timedelta(days=30)
-    })
+    token = await create_session(user_id)
 
-    resp = JSONResponse({"ok": True})
+    resp = ORJSONResponse({"ok": True})
     resp.set_cookie(SESSION_COOKIE, token, httponly=True, samesite="lax")
     return resp
 
 @app.post("/auth/login")
-def login(payload: LoginRequest):
-    user = db["user"].find_one({"email": payload.email})
+async def login(payload: LoginRequest):
+    user = await db["user"].find_one({"email": payload.email})
     if not user:
         raise HTTPException(401, detail="Invalid credentials")
-    # naive password check (only for demo)
-    if str(abs(hash(payload.password))) not in user.get("password_hash", ""):
+    if not await run_in_threadpool(verify_password, payload.password, user.get("password_hash", "")):
         raise HTTPException(401, detail="Invalid credentials")
 
-    token = secrets.token_urlsafe(32)
-    db["session"].insert_one({
-        "user_id": user["_id"],
-        "token": token,
-        "created_at": datetime.utcnow(),
-        "expires_at": datetime.utcnow() + timedelta(days=30)
-    })
+    token = await create_session(user["_id"])
 
-    resp = JSONResponse({"ok": True})
+    resp = ORJSONResponse({"ok": True})
     resp.set_cookie(SESSION_COOKIE, token, httponly=True, samesite="lax")
     return resp
 
 @app.post("/auth/logout")
-def logout(request: Request):
+async def logout(request: Request):
     token = request.cookies.get(SESSION_COOKIE)
     if token:
-        db["session"].delete_many({"token": token})
-    resp = JSONResponse({"ok": True})
+        await db["session"].delete_many({"token": token})
+        _sess_cache.pop(token, None)
+    resp = ORJSONResponse({"ok": True})
     resp.delete_cookie(SESSION_COOKIE)
     return resp
 
-@app.get("/auth/me", response_model=MeResponse)
-def me(user = Depends(get_current_user)):
+@app.get("/auth/me", response_model=None, responses={200: {"model": MeResponse}})
+async def me(request: Request, user = Depends(get_current_user)):
     sub = user.get("subscription", {})
-    return {
+    body = orjson.dumps({
         "name": user.get("name"),
         "email": user.get("email"),
         "plan": sub.get("plan", "basic"),
         "role": user.get("role", "owner")
-    }
+    })
+    # per-session body: key the browser cache on the cookie too
+    return cached_json(request, body, "private, max-age=30", vary="Cookie")
 
 # ---------- Plan enforcement helpers ----------
 
@@ -173,81 +262,152 @@ def get_plan_limits(user_doc: dict) -> PlanLimits:
     plan = user_doc.get("subscription", {}).get("plan", "basic")
     return PLANS.get(plan, PLANS["basic"])
 
+async def current_user_and_limits(user = Depends(get_current_user)) -> tuple[dict, PlanLimits]:
+    """Resolve the user and their plan limits once per request"""
+    return user, get_plan_limits(user)
+
+async def reserve_client_slot(user_doc: dict, limits: PlanLimits) -> bool:
+    """Atomically bump the user's clients_count if the plan allows another client"""
+    # user_doc may come from the session cache, so decide on the stored doc only
+    query = {"_id": user_doc["_id"], "clients_count": {"$exists": True}}
+    if limits.client_limit is not None:
+        query["clients_count"]["$lt"] = limits.client_limit
+    result = await db["user"].update_one(query, {"$inc": {"clients_count": 1}})
+    if result.modified_count == 1:
+        return True
+    # miss: either the limit is reached or the counter predates this field
+    if not await db["user"].find_one(
+        {"_id": user_doc["_id"], "clients_count": {"$exists": False}}, {"_id": 1}
+    ):
+        return False
+    count = await db["client"].count_documents({"owner_id": user_doc["_id"]})
+    await db["user"].update_one(
+        {"_id": user_doc["_id"], "clients_count": {"$exists": False}},
+        {"$set": {"clients_count": count}},
+    )
+    result = await db["user"].update_one(query, {"$inc": {"clients_count": 1}})
+    return result.modified_count == 1
+
+async def reserve_invoice_slot(user_doc: dict, limit: Optional[int], start: datetime) -> bool:
+    """Atomically bump the user's invoices_this_month, resetting it on month rollover"""
+    month = start.strftime("%Y-%m")
+    query = {"_id": user_doc["_id"], "invoice_month": month}
+    if limit is not None:
+        query["invoices_this_month"] = {"$lt": limit}
+    result = await db["user"].update_one(query, {"$inc": {"invoices_this_month": 1}})
+    if result.modified_count == 1:
+        return True
+    # miss: either the limit is reached or this is the first invoice of the month
+    if not await db["user"].find_one(
+        {"_id": user_doc["_id"], "invoice_month": {"$ne": month}}, {"_id": 1}
+    ):
+        return False
+    count = await db["invoice"].count_documents(
+        {"owner_id": user_doc["_id"], "created_at": {"$gte": start}}
+    )
+    await db["user"].update_one(
+        {"_id": user_doc["_id"], "invoice_month": {"$ne": month}},
+        {"$set": {"invoice_month": month, "invoices_this_month": count}},
+    )
+    result = await db["user"].update_one(query, {"$inc": {"invoices_this_month": 1}})
+    return result.modified_count == 1
 
 # ---------- Clients ----------
 class ClientCreate(BaseModel):
     name: str
-    email: Optional[EmailStr] = None
-    phone: Optional[str] = None
-    tin: Optional[str] = None
+    email: Optional[Email] = None
+    phone: Optional[Phone] = None
+    tin: Optional[Tin] = None
     address: Optional[str] = None
     notes: Optional[str] = None
 
-@app.get("/clients")
-def list_clients(user = Depends(get_current_user)):
-    items = list(db["client"].find({"owner_id": user["_id"]}))
-    return [{**{k:v for k,v in i.items() if k != "_id"}, "id": str(i["_id"]) } for i in items]
+# fields returned by GET /clients (owner_id is implied by the session)
+CLIENT_LIST_PROJECTION = {"name": 1, "email": 1, "phone": 1, "tin": 1, "address": 1, "notes": 1}
+
+@app.get("/clients", response_model=None)
+async def list_clients(user = Depends(get_current_user)):
+    cursor = db["client"].find({"owner_id": user["_id"]}, CLIENT_LIST_PROJECTION)
+    items = await cursor.to_list(None)
+    for i in items:
+        i["id"] = str(i.pop("_id"))
+    return items
 
 @app.post("/clients")
-def add_client(payload: ClientCreate, user = Depends(get_current_user)):
-    limits = get_plan_limits(user)
-    current_count = db["client"].count_documents({"owner_id": user["_id"]})
-    if limits.client_limit is not None and current_count >= limits.client_limit:
+async def add_client(payload: ClientCreate, auth = Depends(current_user_and_limits)):
+    user, limits = auth
+    if not await reserve_client_slot(user, limits):
         raise HTTPException(402, detail="Client limit reached for your plan. Please upgrade.")
 
-    data = Client(owner_id=str(user["_id"]), **payload.model_dump())
-    new_id = db["client"].insert_one(data.model_dump()).inserted_id
+    try:
+        data = {**payload.model_dump(), "owner_id": user["_id"]}
+        new_id = (await db["client"].insert_one(data)).inserted_id
+    except Exception:
+        await db["user"].update_one({"_id": user["_id"]}, {"$inc": {"clients_count": -1}})
+        raise
     return {"id": str(new_id)}
 
 # ---------- Invoices ----------
 class InvoiceCreate(BaseModel):
     client_id: str
-    amount: float
+    amount: float = Field(..., gt=0)
     currency: Literal["AOA", "USD", "EUR"] = "AOA"
     description: Optional[str] = None
-    date_issued: date = date.today()
+    date_issued: IssueDate = Field(default_factory=date.today)
     due_date: Optional[date] = None
 
 @app.get("/invoices/monthly-count")
-def invoices_monthly_count(user = Depends(get_current_user)):
+async def invoices_monthly_count(user = Depends(get_current_user)):
     start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    count = db["invoice"].count_documents({"owner_id": user["_id"], "created_at": {"$gte": start}})
+    count = await db["invoice"].count_documents({"owner_id": user["_id"], "created_at": {"$gte": start}})
     return {"count": count}
 
 @app.post("/invoices")
-def create_invoice(payload: InvoiceCreate, user = Depends(get_current_user)):
-    limits = get_plan_limits(user)
-    if user.get("subscription", {}).get("plan") == "basic" and limits.invoice_monthly_limit is not None:
-        start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        count = db["invoice"].count_documents({"owner_id": user["_id"], "created_at": {"$gte": start}})
-        if count >= limits.invoice_monthly_limit:
-            raise HTTPException(402, detail="Monthly invoice limit reached for BASIC plan.")
-
-    inv = Invoice(owner_id=str(user["_id"]), **payload.model_dump())
-    data = inv.model_dump()
-    data["created_at"] = datetime.utcnow()
-    data["updated_at"] = datetime.utcnow()
-    new_id = db["invoice"].insert_one(data).inserted_id
+async def create_invoice(payload: InvoiceCreate, auth = Depends(current_user_and_limits)):
+    user, limits = auth
+    limit = limits.invoice_monthly_limit if limits.name == "basic" else None
+    now = datetime.utcnow()
+    start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if not await reserve_invoice_slot(user, limit, start):
+        raise HTTPException(402, detail="Monthly invoice limit reached for BASIC plan.")
+
+    try:
+        # mode="json" stores the date fields as ISO strings (BSON has no plain date type)
+        data = {**payload.model_dump(mode="json"), "owner_id": user["_id"], "status": "draft"}
+        data["created_at"] = now
+        data["updated_at"] = now
+        new_id = (await db["invoice"].insert_one(data)).inserted_id
+    except Exception:
+        await db["user"].update_one(
+            {"_id": user["_id"], "invoice_month": start.strftime("%Y-%m")},
+            {"$inc": {"invoices_this_month": -1}},
+        )
+        raise
     return {"id": str(new_id)}
 
 # ---------- Dashboard summary ----------
-@app.get("/dashboard/summary")
-def dashboard_summary(user = Depends(get_current_user)):
-    limits = get_plan_limits(user)
-    clients_count = db["client"].count_documents({"owner_id": user["_id"]})
+@app.get("/dashboard/summary", response_model=None)
+async def dashboard_summary(auth = Depends(current_user_and_limits)):
+    user, limits = auth
+    plan = user.get("subscription", {}).get("plan")
     start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    invoices_this_month = db["invoice"].count_documents({"owner_id": user["_id"], "created_at": {"$gte": start}})
-
-    approaching_client_limit = False
-    if limits.client_limit is not None and limits.client_limit > 0:
-        approaching_client_limit = clients_count >= int(0.8 * limits.client_limit)
-
-    approaching_invoice_limit = False
-    if user.get("subscription", {}).get("plan") == "basic" and limits.invoice_monthly_limit is not None:
-        approaching_invoice_limit = invoices_this_month >= int(0.8 * limits.invoice_monthly_limit)
+    # both counts in one round-trip: tag client and invoice rows, then group by tag
+    counts = {c["_id"]: c["n"] async for c in db["client"].aggregate([
+        {"$match": {"owner_id": user["_id"]}},
+        {"$project": {"_id": 0, "kind": {"$literal": "clients"}}},
+        {"$unionWith": {"coll": "invoice", "pipeline": [
+            {"$match": {"owner_id": user["_id"], "created_at": {"$gte": start}}},
+            {"$project": {"_id": 0, "kind": {"$literal": "invoices"}}},
+        ]}},
+        {"$group": {"_id": "$kind", "n": {"$sum": 1}}},
+    ])}
+    clients_count = counts.get("clients", 0)
+    invoices_this_month = counts.get("invoices", 0)
+
+    approaching_client_limit = limits.client_warn is not None and clients_count >= limits.client_warn
+    approaching_invoice_limit = limits.invoice_warn is not None and invoices_this_month >= limits.invoice_warn
 
     return {
-        "plan": user.get("subscription", {}).get("plan"),
+        "plan": plan,
         "clients_count": clients_count,
         "invoices_this_month": invoices_this_month,
         "limits": {
@@ -261,23 +421,28 @@ def dashboard_summary(user = Depends(get_current_user)):
     }
 
 # ---------- Minimal docs/support content ----------
-@app.get("/support/resources")
-def support_resources():
-    return {
-        "videos": [
-            {"title": "Onboarding Tutorial", "url": "https://example.com/video-onboarding"}
-        ],
-        "faq": [
-            {"q": "Como funciona o TIN em Angola?", "a": "O TIN possui 9 dígitos. Validação é automática."}
-        ],
-        "contacts": {
-            "basic": ["Email"],
-            "professional": ["Email", "Chat"],
-            "enterprise": ["Gestor dedicado"]
-        }
+_SUPPORT_BYTES = orjson.dumps({
+    "videos": [
+        {"title": "Onboarding Tutorial", "url": "https://example.com/video-onboarding"}
+    ],
+    "faq": [
+        {"q": "Como funciona o TIN em Angola?", "a": "O TIN possui 9 dígitos. Validação é automática."}
+    ],
+    "contacts": {
+        "basic": ["Email"],
+        "professional": ["Email", "Chat"],
+        "enterprise": ["Gestor dedicado"]
     }
+})
+_SUPPORT_ETAG = '"%s"' % hashlib.md5(_SUPPORT_BYTES).hexdigest()
+
+@app.get("/support/resources")
+async def support_resources(request: Request):
+    return cached_json(request, _SUPPORT_BYTES, "public, max-age=86400", _SUPPORT_ETAG)
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WORKERS", os.cpu_count() or 1))
+    # multiple workers require the app as an import string
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)
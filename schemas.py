@@ -5,12 +5,49 @@ Each Pydantic model represents a MongoDB collection. The collection name is the
 lowercased class name.
 """
 from __future__ import annotations
-from pydantic import BaseModel, Field, EmailStr, field_validator
-from typing import Optional, Literal
+import re
+from pydantic import BaseModel, ConfigDict, Field, AfterValidator
+from typing import Annotated, Any, Optional, Literal
 from datetime import date, datetime
 
 PlanName = Literal["basic", "professional", "enterprise"]
 
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+_TIN_RE = re.compile(r"\d{9}")
+_PHONE_RE = re.compile(r"\+244\d{9}")
+
+def _check_email(v: str) -> str:
+    if not _EMAIL_RE.fullmatch(v):
+        raise ValueError("Invalid email address")
+    # normalize the domain like email-validator did, so stored addresses keep matching
+    local, _, domain = v.rpartition("@")
+    return f"{local}@{domain.lower()}"
+
+def _check_tin(v: str) -> str:
+    if v and not _TIN_RE.fullmatch(v):
+        raise ValueError("TIN must be 9 digits (Angola)")
+    return v
+
+def _check_phone(v: str) -> str:
+    if v and not _PHONE_RE.fullmatch(v):
+        raise ValueError("Phone must be +244 followed by 9 digits")
+    return v
+
+def _check_issue_date(v: date) -> date:
+    if v > date.today():
+        raise ValueError("Issuance date cannot be in the future")
+    return v
+
+# Lightweight email type (precompiled regex instead of email-validator, domain lowercased)
+Email = Annotated[str, AfterValidator(_check_email)]
+# Angolan TIN / phone; empty strings are accepted as "not provided"
+Tin = Annotated[str, AfterValidator(_check_tin)]
+Phone = Annotated[str, AfterValidator(_check_phone)]
+IssueDate = Annotated[date, AfterValidator(_check_issue_date)]
+
+# Shared settings for collection models: drop unknown keys, skip default validation
+_MODEL_CONFIG = ConfigDict(extra="ignore", validate_default=False, str_strip_whitespace=False)
+
 class Subscription(BaseModel):
     plan: PlanName = Field(..., description="Current subscription plan")
     started_at: datetime = Field(default_factory=datetime.utcnow)
@@ -18,34 +55,18 @@ class Subscription(BaseModel):
     status: Literal["active", "past_due", "canceled"] = "active"
 
 class User(BaseModel):
+    model_config = _MODEL_CONFIG
+
     name: str = Field(..., description="Full name")
-    email: EmailStr = Field(..., description="Email address")
+    email: Email = Field(..., description="Email address")
     password_hash: str = Field(..., description="Hashed password")
     company_name: Optional[str] = None
-    company_tin: Optional[str] = Field(None, description="Angolan TIN (9 digits)")
-    phone: Optional[str] = Field(None, description="+244 followed by 9 digits")
+    company_tin: Optional[Tin] = Field(None, description="Angolan TIN (9 digits)")
+    phone: Optional[Phone] = Field(None, description="+244 followed by 9 digits")
     subscription: Subscription
     role: Literal["owner", "admin", "user"] = "owner"
     is_active: bool = True
 
-    @field_validator("company_tin")
-    @classmethod
-    def validate_tin(cls, v: Optional[str]):
-        if v is None or v == "":
-            return v
-        if not (len(v) == 9 and v.isdigit()):
-            raise ValueError("TIN must be 9 digits (Angola)")
-        return v
-
-    @field_validator("phone")
-    @classmethod
-    def validate_phone(cls, v: Optional[str]):
-        if v is None or v == "":
-            return v
-        if not (v.startswith("+244") and len(v) == 13 and v[1:].isdigit()):
-            raise ValueError("Phone must be +244 followed by 9 digits")
-        return v
-
 class Session(BaseModel):
     user_id: str
     token: str
@@ -55,50 +76,28 @@ class Session(BaseModel):
     user_agent: Optional[str] = None
 
 class Client(BaseModel):
-    owner_id: str = Field(..., description="User ID who owns this client")
+    model_config = _MODEL_CONFIG
+
+    owner_id: Any = Field(..., description="User ObjectId who owns this client")
     name: str
-    email: Optional[EmailStr] = None
-    phone: Optional[str] = Field(None, description="+244 followed by 9 digits")
-    tin: Optional[str] = Field(None, description="Angolan TIN (9 digits)")
+    email: Optional[Email] = None
+    phone: Optional[Phone] = Field(None, description="+244 followed by 9 digits")
+    tin: Optional[Tin] = Field(None, description="Angolan TIN (9 digits)")
     address: Optional[str] = None
     notes: Optional[str] = None
 
-    @field_validator("tin")
-    @classmethod
-    def validate_tin(cls, v: Optional[str]):
-        if v is None or v == "":
-            return v
-        if not (len(v) == 9 and v.isdigit()):
-            raise ValueError("TIN must be 9 digits (Angola)")
-        return v
-
-    @field_validator("phone")
-    @classmethod
-    def validate_phone(cls, v: Optional[str]):
-        if v is None or v == "":
-            return v
-        if not (v.startswith("+244") and len(v) == 13 and v[1:].isdigit()):
-            raise ValueError("Phone must be +244 followed by 9 digits")
-        return v
-
 class Invoice(BaseModel):
-    owner_id: str = Field(..., description="User ID who owns this invoice")
+    model_config = _MODEL_CONFIG
+
+    owner_id: Any = Field(..., description="User ObjectId who owns this invoice")
     client_id: str = Field(..., description="Client ID")
     amount: float = Field(..., gt=0)
     currency: Literal["AOA", "USD", "EUR"] = "AOA"
     description: Optional[str] = None
-    date_issued: date = Field(default_factory=date.today)
+    date_issued: IssueDate = Field(default_factory=date.today)
     due_date: Optional[date] = None
     status: Literal["draft", "sent", "paid", "overdue", "canceled"] = "draft"
 
-    @field_validator("date_issued", mode="before")
-    @classmethod
-    def no_future_issue_date(cls, v):
-        d = v if isinstance(v, date) else date.fromisoformat(v)
-        if d > date.today():
-            raise ValueError("Issuance date cannot be in the future")
-        return v
-
 # Simple schema exposer for viewer tools
 class SchemaInfo(BaseModel):
     name: str